@@ -1,10 +1,13 @@
 import airbnb
+import contextlib
 import math
 import os
 import pandas as pd
-import sys
+import threading
 import time
 
+from concurrent.futures import ThreadPoolExecutor
+
 
 class Airbnb(airbnb.Api):
     """
@@ -32,7 +35,7 @@ class Airbnb(airbnb.Api):
         if not isinstance(pages, int) or pages < 1:
             raise ValueError(f'Number of pages ({pages}) must be a positive integer.')
 
-        listings = None
+        frames = []
         last_page = False
 
         for i in range(pages):
@@ -49,12 +52,12 @@ class Airbnb(airbnb.Api):
                 print(f'No results for {query} on page {i+1}')
                 break
 
-            # convert current listings to DataFrame and append to all listings
+            # convert current listings to DataFrame and collect with all listings
+            # (listing and pricing fields are merged into one record per listing)
             current_listings = result['explore_tabs'][0]['sections'][0]['listings']
-            df_list = pd.DataFrame([x['listing'] for x in current_listings])
-            df_price = pd.DataFrame([x['pricing_quote'] for x in current_listings])
-            df = df_list.merge(df_price, left_index=True, right_index=True)
-            listings = listings.append(df) if listings is not None else df
+            frames.append(pd.DataFrame(
+                {**x['listing'], **x['pricing_quote']} for x in current_listings
+            ))
 
             # check if there are additional pages
             # looping once more after has_next_page is false returns a few more results
@@ -65,6 +68,9 @@ class Airbnb(airbnb.Api):
                 else:
                     last_page = True
 
+        # concatenate once instead of appending on every page
+        listings = pd.concat(frames, ignore_index=True) if frames else None
+
         # drop duplicate listings just in case
         if listings is not None:
             listings = listings.drop_duplicates(subset='id')
@@ -88,62 +94,87 @@ class Airbnb(airbnb.Api):
             listings (pandas.DataFrame, None): DataFrame of unique listings or None
         """
 
-        listings = None
+        frames = []
 
         for n in neighborhoods:
-            # get listings for current neighborhood and append to all listings
+            # get listings for current neighborhood and collect with all listings
             df = self.get_listings(
                 f'{n}, {city}', limit=limit, pages=pages, delay=delay
             )
-            listings = listings.append(df) if listings is not None else df
+            if df is not None:
+                frames.append(df)
             time.sleep(delay)
 
+        # concatenate once instead of appending for every neighborhood
+        listings = pd.concat(frames, ignore_index=True) if frames else None
+
         # drop duplicate listings just in case
         if listings is not None:
             listings = listings.drop_duplicates(subset='id')
 
         return listings
 
-    def get_all_reviews(self, listing_ids, limit=100, delay=1):
+    def get_all_reviews(self, listing_ids, limit=100, delay=1, max_workers=16):
         """
         Get all reviews for multiple listings.
         The get_reviews method only returns a batch of reviews for a single listing.
+        Listings are fetched concurrently, but API calls from all threads are
+        spaced out so the overall rate stays at one call per delay.
 
         Parameters:
             listing_ids (iterable): Collection of listing IDs
             limit (int): Number of reviews to return per API call
-            delay (int, float): Amount of time to sleep between API calls
+            delay (int, float): Amount of time to wait between API calls
+            max_workers (int): Number of listings to fetch concurrently
 
         Returns:
             reviews (pandas.DataFrame, None): DataFrame of unique reviews or None
         """
 
-        # block printing to stdout (get_reviews method prints unnecessary messages)
-        sys.stdout = open(os.devnull, 'w')
+        lock = threading.Lock()
+        next_call = time.monotonic()
+
+        def wait():
+            # reserve the next free slot for an API call and sleep until then
+            nonlocal next_call
+            with lock:
+                now = time.monotonic()
+                wait_time = next_call - now
+                next_call = max(now, next_call) + delay
+            if wait_time > 0:
+                time.sleep(wait_time)
 
-        reviews = None
+        def listing_reviews(listing_id):
+            listing_frames = []
 
-        for listing_id in listing_ids:
             # get reviews for current listing
+            wait()
             result = self.get_reviews(listing_id, limit=limit)
             count = result['metadata']['reviews_count']
-            time.sleep(delay)
 
-            # check if there are reviews and append to all reviews
+            # check if there are reviews and collect with all reviews
             if count > 0:
-                df = pd.DataFrame(result['reviews'])
-                reviews = reviews.append(df) if reviews is not None else df
+                listing_frames.append(pd.DataFrame(result['reviews']))
 
             # loop over remaining pages to get all results
             for page in range(1, math.ceil(count / limit)):
-                # get reviews on current page and append to all reviews
+                # get reviews on current page and collect with all reviews
+                wait()
                 result = self.get_reviews(listing_id, limit=limit, offset=page*limit)
-                df = pd.DataFrame(result['reviews'])
-                reviews = reviews.append(df)
-                time.sleep(delay)
+                listing_frames.append(pd.DataFrame(result['reviews']))
+
+            return listing_frames
+
+        frames = []
+
+        # block printing to stdout (get_reviews method prints unnecessary messages)
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            with ThreadPoolExecutor(max_workers=max_workers) as executor:
+                for listing_frames in executor.map(listing_reviews, listing_ids):
+                    frames.extend(listing_frames)
 
-        # enable printing to stdout
-        sys.stdout = sys.__stdout__
+        # concatenate once instead of appending on every page
+        reviews = pd.concat(frames, ignore_index=True) if frames else None
 
         # drop duplicate reviews just in case
         if reviews is not None:
@@ -30,25 +30,18 @@ class NeighborhoodLookup(googlemaps.Client):
         result = self.reverse_geocode(coordinate)
         time.sleep(delay)
 
-        # extract neighborhoods from result
-        neighborhoods = list(
-            {
-                x['long_name']
-                for r in result
-                for x in r['address_components']
-                if 'neighborhood' in x['types']
-            }
-        )
-
-        # extract cities from result
-        cities = list(
-            {
-                x['long_name']
-                for r in result
-                for x in r['address_components']
-                if 'locality' in x['types']
-            }
-        )
+        # extract neighborhoods and cities from result in a single pass
+        neighborhoods, cities = set(), set()
+
+        for r in result:
+            for x in r['address_components']:
+                types = x['types']
+                if 'neighborhood' in types:
+                    neighborhoods.add(x['long_name'])
+                if 'locality' in types:
+                    cities.add(x['long_name'])
+
+        neighborhoods, cities = list(neighborhoods), list(cities)
 
         if len(neighborhoods) > 0:
             return {
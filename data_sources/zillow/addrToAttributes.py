@@ -2,15 +2,28 @@
 # input: csv input data (tab-separated)
 # output: csv output data (comma-separated?)
 import os
+import re
 import sys
 import csv
-import json
+import zlib
+import hashlib
+import sqlite3
 import requests
 
-from time import sleep
 from pprint import pprint
 
-from bs4 import BeautifulSoup as BS
+import lxml.html
+import pandas as pd
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from rate_limit import TokenBucket
+
+# orjson is considerably faster on the large apiCache blobs
+try:
+    from orjson import loads
+except ImportError:
+    from json import loads
 
 try:
     import zillow
@@ -19,6 +32,12 @@ except ImportError:
     print('pip install python-zillow')
     raise
 
+try:
+    import msgpack
+except ImportError:
+    print('msgpack ImportError: parsed pages will not be cached.')
+    msgpack = None
+
 try:
     sys.path.append('../google')
     from google_api import NeighborhoodLookup
@@ -33,8 +52,48 @@ finally:
 csvInput  = '../../data/SDaddr.csv'
 csvOutput = '../../data/zillow_properties.csv'
 
+# Columns of csvInput (it has no header) and how many rows to read at a time
+INPUT_COLUMNS = ['address', 'zipcode', 'latitude', 'longitude']
+CHUNK_SIZE = 1024
+
 api = zillow.ValuationApi()
 
+# Share one session so connections to zillow.com are pooled and reused instead
+# of doing a fresh TCP+TLS handshake for every request. Transient errors and
+# rate limiting responses are retried with backoff.
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+))
+SESSION.headers.update({
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:68.0) Gecko/20100101 Firefox/68.0',
+    'DNT': '1',
+})
+
+# Paces requests to zillow (api lookups and page fetches). Cached pages don't
+# cost anything.
+BUCKET = TokenBucket(rate=2)
+
+# Cache pages in a single sqlite db. This exists to reduce api calls but also
+# because I needed to work without wifi for a little bit :).
+#
+# Pages are zlib compressed. Note that for me, ~1400 uncompressed html files
+# was 1.3 Gb on disk.
+CACHE = sqlite3.connect('html_cache.sqlite')
+CACHE.execute('PRAGMA journal_mode=WAL')
+CACHE.execute('PRAGMA synchronous=NORMAL')
+CACHE.execute('CREATE TABLE IF NOT EXISTS cache (url TEXT PRIMARY KEY, html BLOB)')
+
+# Hashes of input addresses that have already been written to the output csv
+CACHE.execute('CREATE TABLE IF NOT EXISTS seen (hash TEXT PRIMARY KEY)')
+
+# Already parsed apiCache data (msgpack), so re-runs skip html and json parsing.
+# Bump the version if what gets stored changes.
+APICACHE_VERSION = 1
+CACHE.execute('CREATE TABLE IF NOT EXISTS apicache (url TEXT PRIMARY KEY, version INTEGER, data BLOB)')
+
 # The attributes below are assigned later to ZillowProperty objects.
 # The commented-out ones are just in case we want the data later.
 ATTRIBUTES = [
@@ -57,14 +116,94 @@ ATTRIBUTES = [
     'description',
 ]
 
-# csv setup
-if os.path.exists(csvOutput):
-    writer = csv.writer(open(csvOutput, 'a', newline=''))
-else:
-    writer = csv.writer(open(csvOutput, 'w', newline=''))
-    writer.writerow(ATTRIBUTES)
+# Where fillIn looks for each attribute in the apiCache data, keyed by query
+# name. The data is expected to be split under 2 keys, both with relevant
+# information, ex:
+#
+# 'VariantQuery{"zpid":67404285}'
+# 'ForSaleDoubleScrollFullRenderQuery{"zpid":67404285,"contactFormRenderParameter":{"zpid":67404285,"platform":"desktop","isDoubleScroll":true}}'
+#
+# Some attributes are commented out with descriptions of what they represent
+# in case they can be used later.
+SCHEMAS = {
+    'VariantQuery': [
+        ('price',         ['price']),
+        ('latitude',      ['latitude']),
+        ('longitude',     ['longitude']),
+        ('street',        ['streetAddress']),
+        ('city',          ['city']),
+        ('state',         ['state']),
+        ('zipcode',       ['zipcode']),
+        ('bed',           ['bedrooms']),
+        ('bath',          ['bathrooms']),
+        ('year_built',    ['yearBuilt']),
+        ('size',          ['livingArea']),
+
+        #
+        # Lot size and lot size units (acres, etc).
+        #
+
+        #('lot_size',       ['lotAreaValue']),
+        #('lot_size_units', ['lotAreaUnit']),
+    ],
+    'ForSaleDoubleScrollFullRenderQuery': [
+        ('price',         ['price']),
+        ('latitude',      ['latitude']),
+        ('longitude',     ['longitude']),
+        ('street',        ['address', 'streetAddress']),
+        ('city',          ['address', 'city']),
+        ('state',         ['address', 'state']),
+        ('zipcode',       ['address', 'zipcode']),
+        ('neighborhood',  ['address', 'neighborhood']),
+        ('bed',           ['bedrooms']),
+        ('bath',          ['bathrooms']),
+        ('size',          ['livingArea']),
+
+        #
+        # parseable text data given by a human
+        #
+
+        ('description',   ['description']),
+
+        #
+        # I think sqft is implied here since 'lotAreaValue' and 'lotAreaUnits'
+        # should have acreage.
+        #
+
+        #('lot_size',      ['lotSize']),
+    ],
+}
+
+# Every attribute fillIn can get from apiCache data
+FILLABLE = {attr for schema in SCHEMAS.values() for attr, _ in schema}
+
+# The only part of a property page that is used. A regex on the raw bytes finds
+# it without building a parse tree for the whole page.
+APOLLO_SCRIPT = re.compile(
+    rb'<script[^>]*id="hdpApolloPreloadedData"[^>]*>(.*?)</script>', re.DOTALL
+)
+
+# Number of output rows to collect before writing them to the csv
+BATCH_SIZE = 64
+
+# Follows keys into nested data, ex: ['address', 'city'] -> data['address']['city'].
+# Missing keys and null values along the way are expected; None is returned.
+def resolvePath(data, keys):
+    for k in keys:
+        if data is None:
+            return None
+        try:
+            data = data[k]
+        except (KeyError, TypeError):
+            return None
+
+    return data
 
 class ZillowProperty():
+    # Every property has the same fixed set of attributes, so skip the
+    # per-instance __dict__.
+    __slots__ = tuple(ATTRIBUTES)
+
     def __init__(self, **kwargs):
         if not set(kwargs).issubset(ATTRIBUTES):
             raise ValueError('Input attributes are not contained in global attributes.')
@@ -76,7 +215,7 @@ class ZillowProperty():
                 self.__setattr__(attr, None) # helps find missing attributes
         return
 
-    # convert string to attribute (see tryFill for how this is used)
+    # convert string to attribute (see getRow for how this is used)
     def __getitem__(self, key):
         return self.__getattribute__(key)
 
@@ -86,26 +225,13 @@ class ZillowProperty():
     def getMissing(self):
         return [attr for attr in ATTRIBUTES if self.__getattribute__(attr) is None]
 
-    # Tries to fill emtpy attributes with data but swallows any errors while
-    # attempting to do so.
-    #
-    # returns True if the value was updated
-    def tryFill(self, myattribute, data, keys):
-        if self[myattribute] is not None:
-            return False
+    # Attributes as a plain dict, for filling many of them at once (see fillIn)
+    def asDict(self):
+        return {attr: getattr(self, attr) for attr in ATTRIBUTES}
 
-        try:
-            # it works...
-            if len(keys) == 1:
-                self[myattribute] = data[keys[0]]
-                return True
-            elif len(keys) == 2:
-                self[myattribute] = data[keys[0]][keys[1]]
-                return True
-            else:
-                raise ValueError
-        except:
-            return False
+    def update(self, values):
+        for attr, value in values.items():
+            setattr(self, attr, value)
 
     # Returns a "row" intended for csv writing
     def getRow(self):
@@ -119,6 +245,7 @@ class ZillowProperty():
 def getInitialData(key, address, zipcode, latitude=None, longitude=None, ident=0):
 
     # Throws exceptions if zillow returns weird stuff or errors
+    BUCKET.acquire()
     data = api.GetSearchResults(key, address, zipcode)
 
     zp = ZillowProperty(**{
@@ -143,105 +270,126 @@ def getInitialData(key, address, zipcode, latitude=None, longitude=None, ident=0
     return zp, data
 
 
+# Returns the raw html for a zillow url, fetching it only if it isn't cached.
+def getPage(url):
+    row = CACHE.execute('SELECT html FROM cache WHERE url = ?', (url,)).fetchone()
+    if row is not None:
+        return zlib.decompress(row[0])
+
+    # Pages cached by older versions of this script are in html/
+    h = url.lstrip('https://').lstrip('www.zillow.com').replace(' ', '_').replace('/', '_')
+    fname = f'html/{h}.html'
+
+    if os.path.exists(fname):
+        with open(fname, 'rb') as f:
+            raw = f.read()
+    else:
+        BUCKET.acquire()
+        resp = SESSION.get(url)
+
+        # Only successful fetches are cached, otherwise an error page would be
+        # served from the cache on every rerun.
+        resp.raise_for_status()
+        raw = resp.content
+
+    with CACHE:
+        CACHE.execute('INSERT OR REPLACE INTO cache VALUES (?, ?)', (url, zlib.compress(raw)))
+
+    return raw
+
+
+# Returns the parsed apiCache data embedded in a zillow page.
+def getApiCache(url):
+    if msgpack is not None:
+        row = CACHE.execute('SELECT data FROM apicache WHERE url = ? AND version = ?',
+                            (url, APICACHE_VERSION)).fetchone()
+        if row is not None:
+            return msgpack.unpackb(row[0], raw=False)
+
+    raw = getPage(url)
+
+    # zillow returns weird data so the resulting code is funky
+    match = APOLLO_SCRIPT.search(raw)
+    if match is not None:
+        script = match.group(1)
+    else:
+        # unusual markup, fall back to parsing the page
+        script = lxml.html.fromstring(raw).get_element_by_id('hdpApolloPreloadedData').text
+
+    jsondata = loads(script.strip())
+    apicache = loads(jsondata['apiCache'])
+
+    if msgpack is not None:
+        with CACHE:
+            CACHE.execute('INSERT OR REPLACE INTO apicache VALUES (?, ?, ?)',
+                          (url, APICACHE_VERSION, msgpack.packb(apicache)))
+
+    return apicache
+
+
 # Fills in missing data using the url link returned by python-zillow.
 #
 # Some attributes are commented out with descriptions of what they represent
 # in case they can be used later.
 def fillIn(zp):
-    h = zp.url.lstrip('https://').lstrip('www.zillow.com').replace(' ', '_').replace('/', '_')
-    fname = f'html/{h}.html'
+    apicache = getApiCache(zp.url)
 
-    if not os.path.exists('html'):
-        os.mkdir('html')
-    
-    # Cache files to disk. This exists to reduce api calls but also because I 
-    # needed to work without wifi for a little bit :).
-    #
-    # Note that for me, ~1400 files was 1.3 Gb on disk.
-    if not os.path.exists(fname):
-        headers = {}
-        headers['User-Agent'] = 'Mozilla/5.0 (X11; Linux x86_64; rv:68.0) Gecko/20100101 Firefox/68.0'
-        headers['DNT'] = '1'
-
-        data = requests.get(zp.url, headers=headers)
-        soup = BS(data.text, features='lxml')
-
-        with open(fname, 'w') as f:
-            f.write(soup.prettify())
-    else:
-        with open(fname) as f:
-            soup = BS(f, features='lxml')
+    # We treat the data as unreliable and use all sources possible (see
+    # SCHEMAS) to fill in missing data. The work is done on a plain dict and
+    # copied back to zp at the end.
+    fields = zp.asDict()
+    unknown = []
 
-    # zillow returns weird data so the resulting code is funky
-    tag = soup.find('script', {'id': 'hdpApolloPreloadedData'})
-    jsondata = json.loads(list(tag.children)[0].strip())
-    apicache = json.loads(jsondata['apiCache'])
-
-    # The data here is expected to be split under 2 keys, both with relevant
-    # information. We treat the data as unreliable and use all sources possible
-    # to fill in missing data.
-    for key in apicache.keys():
-        # example key we're trying to match: 'VariantQuery{"zpid":67404285}'
-        if 'VariantQuery' in key:
-            moredata = apicache[key]['property']
-
-            _ = zp.tryFill('price',         moredata, ['price'])
-            _ = zp.tryFill('latitude',      moredata, ['latitude'])
-            _ = zp.tryFill('longitude',     moredata, ['longitude'])
-            _ = zp.tryFill('street',        moredata, ['streetAddress'])
-            _ = zp.tryFill('city',          moredata, ['city'])
-            _ = zp.tryFill('state',         moredata, ['state'])
-            _ = zp.tryFill('zipcode',       moredata, ['zipcode'])
-            _ = zp.tryFill('bed',           moredata, ['bedrooms'])
-            _ = zp.tryFill('bath',          moredata, ['bathrooms'])
-            _ = zp.tryFill('year_built',    moredata, ['yearBuilt'])
-            _ = zp.tryFill('size',          moredata, ['livingArea'])
-
-            #
-            # Lot size and lot size units (acres, etc).
-            #
-
-            #z = zp.tryFill('lot_size',   moredata, ['lotAreaValue'])
-            #if z:
-            #    _ = zp.tryFill('lot_size_units', moredata, ['lotAreaUnit'])
-            #        break
-
-        # example key...: 'ForSaleDoubleScrollFullRenderQuery{"zpid":67404285,"contactFormRenderParameter":{"zpid":67404285,"platform":"desktop","isDoubleScroll":true}}'
-        elif 'ForSaleDoubleScrollFullRenderQuery' in key:
-            moredata = apicache[key]['property']
-
-            _ = zp.tryFill('price',         moredata, ['price'])
-            _ = zp.tryFill('latitude',      moredata, ['latitude'])
-            _ = zp.tryFill('longitude',     moredata, ['longitude'])
-            _ = zp.tryFill('street',        moredata, ['address', 'streetAddress'])
-            _ = zp.tryFill('city',          moredata, ['address', 'city'])
-            _ = zp.tryFill('state',         moredata, ['address', 'state'])
-            _ = zp.tryFill('zipcode',       moredata, ['address', 'zipcode'])
-            _ = zp.tryFill('neighborhood',  moredata, ['address', 'neighborhood'])
-            _ = zp.tryFill('bed',           moredata, ['bedrooms'])
-            _ = zp.tryFill('bath',          moredata, ['bathrooms'])
-            _ = zp.tryFill('size',          moredata, ['livingArea'])
-
-            #
-            # parseable text data given by a human
-            #
-
-            _ = zp.tryFill('description', moredata, ['description'])
-            zp.description = zp.description.replace('"', '') # this is for ONE property that
-                                                             # has data that trips up cypher
-
-            #
-            # I think sqft is implied here since 'lotAreaValue' and 'lotAreaUnits'
-            # should have acreage.
-            #
-
-            #z = zp.tryFill('lot_size',   moredata, ['lotSize'])
-        else:
-            with open('JAMES.txt', 'a') as f:
-                f.write(key + '\n')
+    for key, value in apicache.items():
+        # The query name is everything before the first '{'
+        schema = SCHEMAS.get(key.split('{', 1)[0])
+
+        if schema is None:
+            unknown.append(key + '\n')
+            continue
+
+        moredata = value['property']
+
+        for attr, path in schema:
+            if fields[attr] is None:
+                fields[attr] = resolvePath(moredata, path)
+
+        # nothing left for the remaining keys to fill
+        if all(fields[attr] is not None for attr in FILLABLE):
+            break
+
+    if unknown:
+        with open('JAMES.txt', 'a') as f:
+            f.writelines(unknown)
+
+    # this is for ONE property that has data that trips up cypher
+    if fields['description'] is not None:
+        fields['description'] = fields['description'].replace('"', '')
+
+    zp.update(fields)
 
     return zp, apicache
 
+
+# Identifies input addresses (pandas Series) so that duplicate input rows, and
+# rows finished on a previous run, can be skipped before calling any api.
+def addressHashes(addresses, zipcodes):
+    keys = addresses.str.strip().str.lower() + '|' + zipcodes.str.strip()
+    return keys.map(lambda k: hashlib.sha256(k.encode()).hexdigest())
+
+
+# Writes a batch of rows to the csv and records their addresses as done.
+def writeBatch(writer, out, batch, done):
+    writer.writerows(batch)
+    out.flush()
+
+    with CACHE:
+        CACHE.executemany('INSERT OR IGNORE INTO seen VALUES (?)', ((h,) for h in done))
+
+    batch.clear()
+    done.clear()
+
+
 def fillNeighborhood(zp):
     # A sneaky type coersion is here.
     if isinstance(zp.neighborhood, str):
@@ -266,19 +414,57 @@ if True:
     with open(os.path.join(os.path.expanduser('~'), '.zkey')) as f:
         key = f.read().strip()
 
-    with open(csvInput) as f:
-        for i, row in enumerate(csv.reader(f, delimiter='\t')):
-            address, zipcode, latitude, longitude = row
+    # csv setup
+    header = not os.path.exists(csvOutput)
+
+    with open(csvOutput, 'a', newline='', buffering=1 << 20) as out:
+        writer = csv.writer(out)
+        if header:
+            writer.writerow(ATTRIBUTES)
+
+        # Rows are written in batches; whatever is left over (including after
+        # a KeyboardInterrupt) is written on the way out.
+        batch = []
+        done = []
+
+        # Addresses are only skipped as done while the csv they were written to
+        # exists, a new csv starts over.
+        if header:
+            with CACHE:
+                CACHE.execute('DELETE FROM seen')
+
+        # 'written' holds addresses whose rows made it to the csv (on this or a
+        # previous run, see writeBatch) and 'attempted' holds addresses already
+        # taken from the input on this run, so duplicate input rows are skipped
+        # even if their api call failed.
+        written = {h for h, in CACHE.execute('SELECT hash FROM seen')}
+        attempted = set()
+
+        # Each chunk is hashed and de-duplicated before any api calls. The
+        # index holds the row's line number in csvInput, which is used as its id.
+        chunks = pd.read_csv(csvInput, sep='\t', names=INPUT_COLUMNS, dtype=str,
+                             keep_default_na=False, chunksize=CHUNK_SIZE)
 
-            try:
-                zp, apidata = getInitialData(key, address, zipcode, latitude, longitude, i)
-            except ZillowError:
-                print(f'Zillow api did not like this property: {address}', file=sys.stderr)
-                continue
-
-            _, a = fillIn(zp)
-            _, b = fillNeighborhood(zp)
-            
-            writer.writerow(zp.getRow())
-
-            sleep(.5)    
+        try:
+            for chunk in chunks:
+                chunk['hash'] = addressHashes(chunk['address'], chunk['zipcode'])
+                chunk = chunk.drop_duplicates('hash')
+                chunk = chunk[~chunk['hash'].isin(written) & ~chunk['hash'].isin(attempted)]
+                attempted.update(chunk['hash'])
+
+                for i, address, zipcode, latitude, longitude, h in chunk.itertuples(name=None):
+                    try:
+                        zp, apidata = getInitialData(key, address, zipcode, latitude, longitude, i)
+                    except ZillowError:
+                        print(f'Zillow api did not like this property: {address}', file=sys.stderr)
+                        continue
+
+                    _, a = fillIn(zp)
+                    _, b = fillNeighborhood(zp)
+
+                    batch.append(zp.getRow())
+                    done.append(h)
+                    if len(batch) >= BATCH_SIZE:
+                        writeBatch(writer, out, batch, done)
+        finally:
+            writeBatch(writer, out, batch, done)
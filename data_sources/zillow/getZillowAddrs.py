@@ -9,17 +9,71 @@
 #
 import os
 import sys
-import json
+import asyncio
 import requests
 import random
 
-from time import sleep
+import aiohttp
+import lxml.html
+from aiolimiter import AsyncLimiter
+from lxml import etree
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
-from bs4 import BeautifulSoup as BS
+from rate_limit import TokenBucket
+
+# Prefer orjson for speed. Both versions of dumps produce compact json.
+try:
+    import orjson
+
+    # orjson only takes exact str/bytes types, so str subclasses (ex: parser
+    # strings from lxml or bs4) are converted to a plain str first.
+    def loads(data):
+        if type(data) not in (str, bytes, bytearray, memoryview):
+            data = str(data)
+        return orjson.loads(data)
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode()
+except ImportError:
+    import json
+
+    loads = json.loads
+
+    def dumps(obj):
+        return json.dumps(obj, separators=(',', ':'))
 
 sep = '\t'
 theyknow = 0
 
+# Zip code searches are I/O bound so several are kept in flight at once. The
+# rate limiter keeps the overall pace at what the old sleep(1) loop allowed.
+MAX_CONNECTIONS = 8     # open connections to zillow.com
+MAX_REQUESTS = 16       # requests in flight
+REQUESTS_PER_SECOND = 1
+
+# Text of every <script> inside the property list items of a search page.
+# smart_strings=False returns plain strs (not lxml's str subclass), which is
+# what orjson.loads requires.
+PROPERTY_SCRIPTS = etree.XPath(
+    '//ul[contains(concat(" ", normalize-space(@class), " "), " photo-cards ")]//li//script/text()',
+    smart_strings=False,
+)
+
+# Pooled session for the synchronous GetSearchPageState requests (retries 429s
+# and server errors with backoff).
+SESSION = requests.Session()
+SESSION.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 500, 502, 503, 504]),
+))
+SESSION.headers.update({
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64; rv:68.0) Gecko/20100101 Firefox/68.0',
+    'DNT': '1',
+})
+BUCKET = TokenBucket(rate=REQUESTS_PER_SECOND)
+
 def _zip_GetSearch(zipcode, price):
     global theyknow
 
@@ -55,21 +109,17 @@ def _zip_GetSearch(zipcode, price):
 
     url  =  'https://www.zillow.com/search/GetSearchPageState.htm'
     # dump json objects without any whitespace to match what zillow.com does normally.
-    url += f'?searchQueryState={json.dumps(searchQueryState, separators=(",", ":"))}'
-    url += f'&wants={json.dumps(wants, separators=(",", ":"))}'
+    url += f'?searchQueryState={dumps(searchQueryState)}'
+    url += f'&wants={dumps(wants)}'
     url +=  '&requestId=1'
 
-    headers = {}
-    headers['User-Agent'] = 'Mozilla/5.0 (X11; Linux x86_64; rv:68.0) Gecko/20100101 Firefox/68.0'
-    headers['DNT'] = '1'
-
     # Send and extract request
-    data = requests.get(url, headers=headers)
-    soup = BS(data.text, features='lxml')
+    BUCKET.acquire()
+    data = SESSION.get(url)
 
-    # The result is (expected to be) a large json object enclosed in a few tags:
-    # <html><body><p>{object}</p></body></html>
-    jsondata = json.loads(soup.find('p').contents[0])
+    # The result is (expected to be) a large bare json object, which is loaded
+    # straight from the response bytes.
+    jsondata = loads(data.content)
 
     if jsondata['user']['isBot']:
         if not theyknow:
@@ -123,11 +173,10 @@ def zip_GetSearch(zipcode):
     #return _zip_GetSearch(zipcode, price={'max': 750000}) + \
     #       _zip_GetSearch(zipcode, price={'min': 750000}) 
 
+# @session: aiohttp.ClientSession
 # @zipcode: string zipcode
 # returns list of tuples
-def zip_rb(zipcode, prevzip='92111'):
-    ret = []
-
+async def zip_rb(session, zipcode, prevzip='92111'):
     # Setup request
     #url = f'https://www.zillow.com/homes/{zipcode}_rb/'
     #url += '?fromHomePage=true'
@@ -144,83 +193,112 @@ def zip_rb(zipcode, prevzip='92111'):
     headers['Referer'] = f'https://www.zillow.com/homes/{prevzip}_rb/'
     headers['DNT'] = '1'
 
-    # Send and extract request
-    data = requests.get(url, headers=headers)
-    soup = BS(data.text, features='lxml')
+    # Send request. The body is kept as bytes, which skips decoding the whole
+    # page to a str. lxml is told the charset from the response headers since
+    # without a <meta charset> it would otherwise assume latin-1.
+    async with session.get(url, headers=headers) as resp:
+        body = await resp.read()
+        encoding = resp.charset or 'utf-8'
+
+    # Parsing is CPU bound so it runs in a worker thread, letting the event
+    # loop keep other requests moving in the meantime.
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, parse_rb, body, encoding)
+
+# @body: html (bytes) of a zip code search page
+# @encoding: charset of body
+# returns list of tuples
+def parse_rb(body, encoding='utf-8'):
+    ret = []
+
+    tree = lxml.html.fromstring(body, parser=lxml.html.HTMLParser(encoding=encoding))
 
     # Most zip codes only return one 'ul' tag. Investigation could be done
     # into the instances where there are more than one, but it's not likely
     # worth the time.
-    for properties in soup.find_all('ul', {'class': 'photo-cards'}):
-
-        # Each 'ul' tag has multiple properties enclosed in 'li' tags.
-        for prop in properties.find_all('li'):
-            # Skip stuff like the following:
-            # <li>1,328<abbr class="list-card-label"> <!-- -->sqft</abbr></li>
-            if not (scripts := prop.find_all('script')):
-                continue
+    #
+    # Each 'ul' tag has multiple properties enclosed in 'li' tags, most with a
+    # single <script> tag. Items without one, like the following, are skipped:
+    # <li>1,328<abbr class="list-card-label"> <!-- -->sqft</abbr></li>
+    for script in PROPERTY_SCRIPTS(tree):
+        # TODO: literally any validation
+        jsondata = loads(script)
+
+        # Only other type I've seen is "Event"
+        if jsondata.get('@type') != 'SingleFamilyResidence':
+            continue
 
-            # This loop is generally a single iteration since most properties only
-            # have one <script> tag.
-            for script in scripts:
-                # TODO: literally any validation
-                jsondata = json.loads(script.contents[0])
-
-                # Only other type I've seen is "Event"
-                if jsondata['@type'] != 'SingleFamilyResidence':
-                    continue
-
-                # Below is an example "jsondata":
-                #
-                # Note that 'name' appears to be a reliable field, we don't
-                # (necessarily) need to use the 'address' field to get the
-                # address.
-                #
-                # {'@context': 'http://schema.org',
-                # '@type': 'SingleFamilyResidence',
-                # 'address': {'@context': 'http://schema.org',
-                #             '@type': 'PostalAddress',
-                #             'addressLocality': 'San Diego',
-                #             'addressRegion': 'CA',
-                #             'postalCode': '92128',
-                #             'streetAddress': '13683 Essence Rd'},
-                # 'floorSize': {'@context': 'http://schema.org',
-                #             '@type': 'QuantitativeValue',
-                #             'value': '1,831'},
-                # 'geo': {'@context': 'http://schema.org',
-                #         '@type': 'GeoCoordinates',
-                #         'latitude': 32.969023,
-                #         'longitude': -117.067697},
-                # 'name': '13683 Essence Rd, San Diego, CA 92128',
-                # 'url': 'https://www.zillow.com/homedetails/13683-Essence-Rd-San-Diego-CA-92128/16800594_zpid/'
-                # }
-
-                address = jsondata['name']
-
-                # Not sure what this means but it's safe to discard these.
-                if address == '--':
-                    continue
+        # Below is an example "jsondata":
+        #
+        # Note that 'name' appears to be a reliable field, we don't
+        # (necessarily) need to use the 'address' field to get the
+        # address.
+        #
+        # {'@context': 'http://schema.org',
+        # '@type': 'SingleFamilyResidence',
+        # 'address': {'@context': 'http://schema.org',
+        #             '@type': 'PostalAddress',
+        #             'addressLocality': 'San Diego',
+        #             'addressRegion': 'CA',
+        #             'postalCode': '92128',
+        #             'streetAddress': '13683 Essence Rd'},
+        # 'floorSize': {'@context': 'http://schema.org',
+        #             '@type': 'QuantitativeValue',
+        #             'value': '1,831'},
+        # 'geo': {'@context': 'http://schema.org',
+        #         '@type': 'GeoCoordinates',
+        #         'latitude': 32.969023,
+        #         'longitude': -117.067697},
+        # 'name': '13683 Essence Rd, San Diego, CA 92128',
+        # 'url': 'https://www.zillow.com/homedetails/13683-Essence-Rd-San-Diego-CA-92128/16800594_zpid/'
+        # }
+
+        address = jsondata['name']
+
+        # Not sure what this means but it's safe to discard these.
+        if address == '--':
+            continue
 
-                try:
-                    # this often doesn't actually match the input zipcode
-                    returned_zip = jsondata['address']['postalCode']
-                except KeyError: # I haven't observed this
-                    continue
+        try:
+            # this often doesn't actually match the input zipcode
+            returned_zip = jsondata['address']['postalCode']
+        except KeyError: # I haven't observed this
+            continue
 
-                try:
-                    latitude = str(jsondata['geo']['latitude'])
-                except KeyError:
-                    latitude = ''
+        try:
+            latitude = str(jsondata['geo']['latitude'])
+        except KeyError:
+            latitude = ''
 
-                try:
-                    longitude = str(jsondata['geo']['longitude'])
-                except KeyError:
-                    longitude = ''
+        try:
+            longitude = str(jsondata['geo']['longitude'])
+        except KeyError:
+            longitude = ''
 
-                ret.append((address, returned_zip, latitude, longitude))
+        ret.append((address, returned_zip, latitude, longitude))
 
     return ret
 
+async def process_zip(sem, limiter, session, zipcode, zips):
+    async with sem:
+        # Jitter so requests don't go out in lockstep
+        await asyncio.sleep(random.uniform(0.5, 1.5))
+
+        async with limiter:
+            results = await zip_rb(session, zipcode, random.choice(zips))
+
+    for res in results:
+        print(sep.join(res))
+
+async def search_zips(zips):
+    sem = asyncio.Semaphore(MAX_REQUESTS)
+    limiter = AsyncLimiter(REQUESTS_PER_SECOND, 1)
+
+    # Reuse connections across all zip codes instead of reconnecting each time
+    connector = aiohttp.TCPConnector(limit_per_host=MAX_CONNECTIONS, keepalive_timeout=60)
+    async with aiohttp.ClientSession(connector=connector) as session:
+        await asyncio.gather(*(process_zip(sem, limiter, session, z, zips) for z in zips))
+
 if __name__ == '__main__':
     hd = '/home/james/2019-jlogan/DSE203/proj/203_final/'
 
@@ -233,15 +311,8 @@ if __name__ == '__main__':
     with open(os.path.join(hd, 'data/SDzip.txt')) as f:
         zips = [z.strip() for z in f.readlines()]
 
-    for zipcode in zips:
-        #if int(zipcode) < 92121:
-        #    continue
-        results = zip_rb(zipcode, random.choice(zips))
-
-        for res in results:
-            print(sep.join(res))
-
-        sleep(1)
+    #zips = [z for z in zips if int(z) >= 92121]
+    asyncio.run(search_zips(zips))
 
     if theyknow:
         print(f'They caught us {theyknow} times.')
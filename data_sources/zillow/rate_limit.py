@@ -0,0 +1,39 @@
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Token bucket rate limiter for blocking code. Calls may burst up to the
+    bucket's capacity, after which they are spaced out to the given rate.
+    """
+
+    def __init__(self, rate, capacity=None):
+        """
+        Parameters:
+            rate (int, float): Tokens added per second
+            capacity (int, float): Maximum number of stored tokens, defaults to rate
+        """
+
+        self.rate = rate
+        self.capacity = max(1, rate if capacity is None else capacity)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, sleeping until one is available.
+        """
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.rate)
+                self.tokens = 1
+                self.last = time.monotonic()
+
+            self.tokens -= 1
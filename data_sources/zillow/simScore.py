@@ -1,22 +1,41 @@
 #!/usr/bin/env python
-import ast
 import datetime
+import math
 import os
+import sys
 import time
 from abc import ABC, abstractmethod
-from itertools import combinations, product
+from concurrent.futures import ProcessPoolExecutor
 from string import digits
 
+import numpy as np
 from neo4j import GraphDatabase
 from py_stringmatching import Cosine
+from scipy import sparse
 from tqdm import tqdm
 
+# numba compiles the pairwise scoring loops; plain numpy is used without it
+try:
+    from numba import njit, prange, vectorize
+except ImportError:
+    print('numba ImportError: falling back to numpy for scoring.')
+    njit = None
+
 uri = 'bolt://localhost:7687'
 user = 'neo4j'
 pw = os.environ['NEO4JPW']
 
 cosine_sim = Cosine().get_sim_score
 
+# number of relationships sent to neo4j per query/transaction
+BATCH_SIZE = 10000
+
+# rows per block when scoring zillow pairs with numpy
+TILE_ROWS = 256
+
+# candidate pairs below this are scored in process instead of in a pool
+PARALLEL_MIN_PAIRS = 200000
+
 # attributes that need to be converted from strings
 key_to_type = {
     'id':    int,
@@ -55,25 +74,250 @@ def num_sim(base_val, comp_val, ratio):
     return (ratio - diff) / ratio
 
 
+# Vectorized num_sim for numpy arrays that broadcast against each other, ex:
+# num_sim_array(a[:, None], a[None, :], ratio) compares every pair in a.
+#
+# Missing values are stored as NaN (see numeric_column) and pairs where either
+# value is missing score 0, same as the all((a, b)) checks in the compare
+# methods. The masks are built on the inputs before they are broadcast.
+def num_sim_array(base_vals, comp_vals, ratio):
+    present = np.isfinite(base_vals) & np.isfinite(comp_vals)
+
+    with np.errstate(invalid='ignore'):
+        diff = np.minimum(np.abs(base_vals - comp_vals) / ((base_vals + comp_vals) / 2), ratio)
+
+    return np.where(present, (ratio - diff) / ratio, 0)
+
+
+# Parses neighborhoods that were stored as a string, ex:
+# "['Del Cerro', 'Kensington']" -> ['Del Cerro', 'Kensington']
+# Same as the parsing in cyphers/2_zillow.cyphers, which is much cheaper than
+# ast.literal_eval since names never contain commas or quotes.
+def parse_neighborhoods(value):
+    inner = value.strip()[1:-1]
+    if not inner.strip():
+        return []
+    return [n.strip().replace("'", '').replace('"', '') for n in inner.split(',')]
+
+
+# (attribute, converter) for each query column, ex: 'p.price' -> ('price', int).
+# Built once per query so that records can be unpacked by position without
+# parsing keys or looking up key_to_type for every row. Columns that don't need
+# converting have a converter of None.
+def field_plan(keys):
+    plan = []
+    for k in keys:
+        attr = k.split('.')[1] if '.' in k else k
+        plan.append((attr, key_to_type.get(attr)))
+    return plan
+
+
+# Runs a query and returns its results as columns ({attribute: list of values})
+# following field_plan. Records are unpacked with values() in column order, so
+# no object is built per property.
+def fetch_columns(session, query):
+    result = session.run(query)
+    plan = field_plan(result.keys())
+    rows = [record.values() for record in result]
+    values = map(list, zip(*rows)) if rows else ([] for _ in plan)
+
+    columns = {}
+    for (attr, convert), column in zip(plan, values):
+        if convert is not None:
+            column = [None if v is None else convert(v) for v in column]
+        columns[attr] = column
+
+    if 'neighborhood' in columns:
+        columns['neighborhood'] = [parse_neighborhoods(v) if isinstance(v, str) else v
+                                   for v in columns['neighborhood']]
+
+    return columns
+
+
+# Numeric column as an array. Missing values are NaN, including 0 since the
+# compare methods treat it as missing too.
+def numeric_column(columns, attr):
+    return np.array([v or np.nan for v in columns[attr]], dtype=np.float64)
+
+
+# translate() table that removes digits
+_DIGIT_TBL = str.maketrans('', '', digits)
+
+
+# Removes digits, surrounding whitespace and case from a street, ex:
+# '123 Main St ' -> 'main st'. Results are interned so equal streets are the
+# same object and compare (or hash into group_ids) by identity.
+def strip_street(street):
+    return sys.intern(street.translate(_DIGIT_TBL).strip().lower())
+
+
+# Maps values (ex: stripped streets) to integer group ids shared across all of
+# the given columns, so that they can be compared as ints instead of strings.
+# Returns one array per column.
+def group_ids(*columns):
+    groups = {}
+    return [np.array([groups.setdefault(v, len(groups)) for v in column], dtype=np.int64)
+            for column in columns]
+
+
+# Converts columns of sets (or lists) to sparse matrices with one L2 normalized
+# indicator row per set, sharing the same vocabulary. The dot product of two
+# rows is the cosine similarity of their sets.
+def set_matrices(*columns):
+    vocab = {}
+    parts = []
+
+    for column in columns:
+        data, indices, indptr = [], [], [0]
+        for tokens in column:
+            tokens = set(tokens or ())
+            if tokens:
+                indices.extend(vocab.setdefault(t, len(vocab)) for t in tokens)
+                data.extend([1 / math.sqrt(len(tokens))] * len(tokens))
+            indptr.append(len(indices))
+        parts.append((data, indices, indptr))
+
+    return [sparse.csr_matrix(part, shape=(len(part[2]) - 1, len(vocab))) for part in parts]
+
+
+# cosine_sim between the rows at each (left_idx, right_idx) pair of two
+# matrices from set_matrices, computed as row-wise dot products.
+def cosine_pairs(left, right, left_idx, right_idx):
+    cos = np.asarray(left[left_idx].multiply(right[right_idx]).sum(axis=1)).ravel()
+
+    # cosine_sim treats two empty sets as an exact match
+    left_empty = np.diff(left.indptr) == 0
+    right_empty = np.diff(right.indptr) == 0
+    cos[left_empty[left_idx] & right_empty[right_idx]] = 1
+
+    return cos
+
+
+# Arrays needed by neighborhood_pairs for two sets of property columns, keyed
+# with a 1 (left) or 2 (right) suffix.
+def neighborhood_arrays(left, right):
+    arrays = {}
+    arrays['neighborhood1'], arrays['neighborhood2'] = set_matrices(
+        left['neighborhood'], right['neighborhood'])
+    arrays['city1'], arrays['city2'] = group_ids(left['city'], right['city'])
+
+    return arrays
+
+
+# Neighborhood similarity at each (idx1, idx2) pair of properties, falling
+# back to comparing cities when either property has no neighborhoods.
+def neighborhood_pairs(arrays, idx1, idx2):
+    left, right = arrays['neighborhood1'], arrays['neighborhood2']
+    both_have = (np.diff(left.indptr) > 0)[idx1] & (np.diff(right.indptr) > 0)[idx2]
+
+    return np.where(both_have,
+                    cosine_pairs(left, right, idx1, idx2),
+                    arrays['city1'][idx1] == arrays['city2'][idx2])
+
+
+# Blocking for comparisons that weigh neighborhoods. Returns (left_idx,
+# right_idx) arrays of the pairs that share a neighborhood, or share a city
+# when either property has no neighborhoods. Every other pair gets nothing for
+# neighborhood/city, which already keeps it under the airbnb thresholds.
+def neighborhood_candidates(left, right):
+    by_neighborhood, by_city, by_city_without = {}, {}, {}
+
+    for j, (neighborhoods, city) in enumerate(zip(right['neighborhood'], right['city'])):
+        by_city.setdefault(city, []).append(j)
+        if neighborhoods:
+            for n in set(neighborhoods):
+                by_neighborhood.setdefault(n, []).append(j)
+        else:
+            by_city_without.setdefault(city, []).append(j)
+
+    # Candidates are kept as one small array per row rather than as python
+    # ints, since there can be many more pairs than properties.
+    left_parts, right_parts = [np.empty(0, dtype=np.int64)], [np.empty(0, dtype=np.int64)]
+
+    for i, (neighborhoods, city) in enumerate(zip(left['neighborhood'], left['city'])):
+        if neighborhoods:
+            js = {j for n in set(neighborhoods) for j in by_neighborhood.get(n, ())}
+            js.update(by_city_without.get(city, ()))
+        else:
+            js = by_city.get(city, ())
+
+        js = np.fromiter(js, dtype=np.int64, count=len(js))
+
+        # comparisons are symmetric so only keep each pair once
+        if left is right:
+            js = js[js > i]
+
+        left_parts.append(np.full(len(js), i, dtype=np.int64))
+        right_parts.append(js)
+
+    return np.concatenate(left_parts), np.concatenate(right_parts)
+
+
+if njit is not None:
+    # num_sim with the missing value (NaN) check folded in
+    @njit(inline='always')
+    def _num_sim_nb(base_val, comp_val, ratio):
+        if np.isnan(base_val) or np.isnan(comp_val):
+            return 0.0
+        diff = min(abs(base_val - comp_val) / ((base_val + comp_val) / 2), ratio)
+        return (ratio - diff) / ratio
+
+    # weight * num_sim as a compiled ufunc, missing value (NaN) check included,
+    # so each attribute is a single pass over the candidate pairs. The
+    # default (single threaded) target is used since scoring already runs in
+    # one process per core.
+    @vectorize(['float64(float64, float64, float64, float64)'])
+    def weighted_sim(base_val, comp_val, ratio, weight):
+        if np.isnan(base_val) or np.isnan(comp_val):
+            return 0.0
+        diff = min(abs(base_val - comp_val) / ((base_val + comp_val) / 2), ratio)
+        return weight * ((ratio - diff) / ratio)
+
+    # Compiled ZPFG.zillowCompare over every pair. Streets are compared by
+    # group id (see group_ids). Only the upper triangle (i < j) is filled in.
+    @njit(parallel=True)
+    def _zillow_score_kernel(price, bed, bath, size, street):
+        n = price.shape[0]
+        out = np.zeros((n, n))
+
+        for i in prange(n):
+            for j in range(i + 1, n):
+                score = 0.5 * _num_sim_nb(price[i], price[j], 0.3)
+                if street[i] == street[j]:
+                    score += 0.2
+                score += 0.1 * _num_sim_nb(bed[i], bed[j], 0.5)
+                score += 0.1 * _num_sim_nb(bath[i], bath[j], 0.5)
+                score += 0.1 * _num_sim_nb(size[i], size[j], 0.3)
+                out[i, j] = score
+
+        return out
+else:
+    def weighted_sim(base_vals, comp_vals, ratio, weight):
+        return weight * num_sim_array(base_vals, comp_vals, ratio)
+
+
 class PropertyContainer(ABC):
-    def __init__(self, info):
-        self.print_keys = []
-
-        for k, v in info.items():
-            # Convert neo4j string to something we want to use ex: 'p.price' -> 'price'
-            actual_key = k.split('.')[1] if '.' in k else k
-            self.print_keys.append(actual_key)
-
-            if actual_key in key_to_type:
-                if v is None:
-                    self[actual_key] = None
-                else:
-                    self[actual_key] = key_to_type[actual_key](v)
-            elif actual_key == 'neighborhood' and isinstance(v, str):
+    # Slots make attribute access faster and objects smaller. Subclasses add
+    # the attributes their query returns.
+    __slots__ = ('id', 'bed', 'bath', 'city', 'neighborhood', 'neighborhood_set')
+
+    # attributes shown when printing, in query order
+    _FIELDS = ()
+
+    # 'plan' is the field_plan for the record's keys. Pass it in when building
+    # many objects from one query so it is only worked out once.
+    def __init__(self, info, plan=None):
+        if plan is None:
+            plan = field_plan(info.keys())
+
+        for (attr, convert), v in zip(plan, info.values()):
+            if convert is not None and v is not None:
+                v = convert(v)
+            elif attr == 'neighborhood' and isinstance(v, str):
                 # ex: "['San Diego']"
-                self[actual_key] = ast.literal_eval(v)
-            else:
-                self[actual_key] = v
+                v = parse_neighborhoods(v)
+
+            setattr(self, attr, v)
 
         # Convert neighborhood to set
         try:
@@ -82,13 +326,7 @@ class PropertyContainer(ABC):
             self.neighborhood_set = set()
 
     def __str__(self):
-        return f'{dict(((k, self[k]) for k in self.print_keys))}'
-
-    def __getitem__(self, key):
-        return self.__getattribute__(key)
-
-    def __setitem__(self, key, value):
-        return self.__setattr__(key, value)
+        return f'{dict(((k, getattr(self, k, None)) for k in self._FIELDS))}'
 
     @abstractmethod
     def compare(self, other):
@@ -97,14 +335,17 @@ class PropertyContainer(ABC):
 
 # zillow property from graph
 class ZPFG(PropertyContainer):
+    __slots__ = ('price', 'street', 'size', 'stripped_street')
+    _FIELDS = ('id', 'price', 'street', 'size', 'bed', 'bath', 'city', 'neighborhood')
+
     data_source = 'zillow'
     node_name = 'Property'
 
-    def __init__(self, info):
-        super().__init__(info)
+    def __init__(self, info, plan=None):
+        super().__init__(info, plan)
 
         # Remove digits from street
-        self.stripped_street = self.street.translate({ord(d): None for d in digits})
+        self.stripped_street = strip_street(self.street)
 
     def compare(self, other):
         if isinstance(other, ZPFG):
@@ -112,8 +353,9 @@ class ZPFG(PropertyContainer):
         else:
             return self.airbnbCompare(other)
 
-    # This is called in an NxN fashion but only ~half of the of calls will do
-    # anything since comparisons are symmetric.
+    # Pure function of the two properties, so comparisons are symmetric and
+    # each pair only needs scoring once (zillow_score_matrix only fills in the
+    # upper triangle).
     def zillowCompare(self, other):
         score = 0
 
@@ -166,6 +408,9 @@ class ZPFG(PropertyContainer):
 
 # Container for airbnb data
 class APFG(PropertyContainer):
+    __slots__ = ('type_id', 'amenity_ids', 'amenity_names')
+    _FIELDS = ('id', 'bed', 'bath', 'type_id', 'amenity_ids', 'amenity_names', 'city', 'neighborhood')
+
     data_source = 'airbnb'
     node_name = 'Rental'
 
@@ -204,95 +449,343 @@ class APFG(PropertyContainer):
         return score
 
 
-# Link similar properties together in the db.
+# Vectorized ZPFG.zillowCompare. Returns the NxN matrix of scores between
+# every pair of properties; only the upper triangle is guaranteed to be filled
+# in since comparisons are symmetric. Pairs on the same street are set to 0
+# when same_street is False.
+def zillow_score_matrix(columns, same_street=True):
+    price, bed, bath, size = (numeric_column(columns, a) for a in ('price', 'bed', 'bath', 'size'))
+
+    street, = group_ids(map(strip_street, columns['street']))
+
+    if njit is not None:
+        score = _zillow_score_kernel(price, bed, bath, size, street)
+    else:
+        # Score a block of rows at a time so the temporaries stay small
+        # (TILE_ROWS x N) instead of allocating several NxN arrays.
+        score = np.empty((len(price), len(price)))
+        for start in range(0, len(price), TILE_ROWS):
+            rows = slice(start, start + TILE_ROWS)
+            tile = 0.5 * num_sim_array(price[rows, None], price[None, :], 0.3)
+            tile += 0.2 * (street[rows, None] == street[None, :])
+            tile += 0.1 * num_sim_array(bed[rows, None], bed[None, :], 0.5)
+            tile += 0.1 * num_sim_array(bath[rows, None], bath[None, :], 0.5)
+            tile += 0.1 * num_sim_array(size[rows, None], size[None, :], 0.3)
+            score[rows] = tile
+
+    if not same_street:
+        score[street[:, None] == street[None, :]] = 0
+
+    return score
+
+
+# Cypher version of num_sim for a numeric attribute of nodes p1 and p2
+# (missing values score 0)
+def cypher_num_sim(attr, ratio):
+    a = f'toFloat(coalesce(p1.{attr}, 0))'
+    b = f'toFloat(coalesce(p2.{attr}, 0))'
+    diff = f'abs({a} - {b}) / (({a} + {b}) / 2)'
+
+    return (f'CASE WHEN {a} = 0 OR {b} = 0 THEN 0.0 '
+            f'ELSE ({ratio} - CASE WHEN {diff} < {ratio} THEN {diff} ELSE {ratio} END) / {ratio} END')
+
+
+# Arrays needed by zillow_airbnb_scores (zillow is 1, airbnb is 2)
+def zillow_airbnb_arrays(zillow, airbnb):
+    arrays = neighborhood_arrays(zillow, airbnb)
+    for attr in ('bed', 'bath'):
+        arrays[attr + '1'] = numeric_column(zillow, attr)
+        arrays[attr + '2'] = numeric_column(airbnb, attr)
+
+    return arrays
+
+
+# Vectorized ZPFG.airbnbCompare. Returns the scores of each
+# (zillow_idx, airbnb_idx) pair of properties.
+def zillow_airbnb_scores(arrays, zillow_idx, airbnb_idx):
+    score = weighted_sim(arrays['bed1'][zillow_idx], arrays['bed2'][airbnb_idx], 0.5, 1 / 3)
+    score += weighted_sim(arrays['bath1'][zillow_idx], arrays['bath2'][airbnb_idx], 0.5, 1 / 3)
+    score += 1 / 3 * neighborhood_pairs(arrays, zillow_idx, airbnb_idx)
+
+    return score
+
+
+# Arrays needed by airbnb_scores
+def airbnb_arrays(columns):
+    arrays = neighborhood_arrays(columns, columns)
+    arrays['type_id'], = group_ids(columns['type_id'])
+    arrays['amenity_ids'], = set_matrices(columns['amenity_ids'])
+    arrays['amenity_names'], = set_matrices(columns['amenity_names'])
+    for attr in ('bed', 'bath'):
+        arrays[attr] = numeric_column(columns, attr)
+
+    return arrays
+
+
+# Vectorized APFG.airbnbCompare. Returns the scores of each (idx1, idx2) pair
+# of properties.
+def airbnb_scores(arrays, idx1, idx2):
+    bed, bath, type_id = arrays['bed'], arrays['bath'], arrays['type_id']
+    amenity_ids, amenity_names = arrays['amenity_ids'], arrays['amenity_names']
+
+    score = weighted_sim(bed[idx1], bed[idx2], 0.5, 0.25)
+    score += weighted_sim(bath[idx1], bath[idx2], 0.5, 0.25)
+    score += 0.3 * neighborhood_pairs(arrays, idx1, idx2)
+    score += 0.1 * (type_id[idx1] == type_id[idx2])
+    score += 0.05 * cosine_pairs(amenity_ids, amenity_ids, idx1, idx2)
+    score += 0.05 * cosine_pairs(amenity_names, amenity_names, idx1, idx2)
+
+    return score
+
+
+# Arrays and scoring function installed in each worker process by
+# init_worker, so they are only pickled once per worker instead of per chunk.
+_worker = {}
+
+
+def init_worker(score_fn, arrays):
+    _worker['score_fn'] = score_fn
+    _worker['arrays'] = arrays
+
+
+# Scores one chunk of candidate pairs in a worker process and only sends back
+# the pairs that are at or above the threshold.
+def score_chunk(idx1, idx2, threshold):
+    score = _worker['score_fn'](_worker['arrays'], idx1, idx2)
+    keep = score >= threshold
+    return idx1[keep], idx2[keep], score[keep]
+
+
+# Scores candidate (idx1, idx2) pairs with score_fn(arrays, idx1, idx2),
+# sharding them across a process pool. Returns the (idx1, idx2, score) arrays
+# of the pairs that are at or above the threshold.
+def parallel_scores(score_fn, arrays, idx1, idx2, threshold):
+    workers = os.cpu_count() or 1
+
+    if workers == 1 or len(idx1) < PARALLEL_MIN_PAIRS:
+        init_worker(score_fn, arrays)
+        return score_chunk(idx1, idx2, threshold)
+
+    chunk_size = max(PARALLEL_MIN_PAIRS // 4, -(-len(idx1) // (4 * workers)))
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_worker,
+                             initargs=(score_fn, arrays)) as executor:
+        futures = [executor.submit(score_chunk, idx1[i:i + chunk_size], idx2[i:i + chunk_size], threshold)
+                   for i in range(0, len(idx1), chunk_size)]
+        results = [f.result() for f in tqdm(futures)]
+
+    return tuple(np.concatenate(parts) for parts in zip(*results))
+
+
+# Relationship rows ({'id1', 'id2', 'score'}) for every (left_idx, right_idx)
+# pair whose score is at or above the threshold.
+def similar_pairs(left, right, left_idx, right_idx, scores, threshold):
+    keep = scores >= threshold
+    left_ids, right_ids = left['id'], right['id']
+    return [{'id1': left_ids[i], 'id2': right_ids[j], 'score': float(score)}
+            for i, j, score in zip(left_idx[keep], right_idx[keep], scores[keep])]
+
+
+def relation_name(cls1, cls2):
+    return f'{cls1.data_source} <--> {cls2.data_source} relationships'
+
+
+# Runs a write query in its own transaction. write_transaction retries it on
+# transient errors (ex: deadlocks).
+def write(session, query, **params):
+    return session.write_transaction(lambda tx: tx.run(query, **params).consume())
+
+
+# Runs apoc.periodic.iterate with 'inner' applied to the rows returned by
+# 'outer'. params are passed to both statements. apoc reports failed batches
+# in its result instead of raising, so that is checked here. Returns the
+# result record (total, updateStatistics, ...).
+def periodic_iterate(session, outer, inner, batch_size=BATCH_SIZE, **params):
+    query = '''CALL apoc.periodic.iterate($outer, $inner,
+                                          {batchSize: $batch_size, params: $params})
+               YIELD batches, total, failedBatches, errorMessages, updateStatistics
+               RETURN batches, total, failedBatches, errorMessages, updateStatistics'''
+
+    result = session.run(query, outer=outer, inner=inner,
+                         batch_size=batch_size, params=params).single()
+
+    if result['failedBatches'] > 0:
+        raise RuntimeError(f"{result['failedBatches']} of {result['batches']} batches "
+                           f"failed: {result['errorMessages']}")
+
+    return result
+
+
+# Sends rows to an 'UNWIND $rows' query, one transaction per batch.
+def write_batches(session, query, rows, progress=False):
+    batches = range(0, len(rows), BATCH_SIZE)
+    for i in tqdm(batches) if progress else batches:
+        write(session, query, rows=rows[i:i + BATCH_SIZE])
+
+
+# Link similar properties together in the db. 'similar' holds relationship
+# rows (see similar_pairs) between cls1 and cls2 nodes that are already above
+# the threshold and 'total' is the number of pairs that were compared.
 #
 # Note that Neo4j does not support creating undirected edges. Therefore we
 # end up creating both incoming and outgoing (directed) relationships between
 # "similar" nodes.
-def connect_nodes(driver, pairs, threshold):
-    pairs = list(pairs)
-    relation = f'{pairs[0][0].data_source} <--> {pairs[0][1].data_source} relationships'
-    count = 0
+#
+# Relationships are sent in batches with UNWIND, one transaction per batch.
+def create_similar(session, similar, cls1, cls2, total):
+    relation = relation_name(cls1, cls2)
 
     print(f'Creating {relation}')
 
-    with driver.session() as session:
-        for p1, p2 in tqdm(pairs):
-            score = p1.compare(p2)  # compare properties
-
-            # create relationship
-            if score >= threshold:
-                is_similar = f'[:Is_Similar {{score: {score}}}]'
-                query = f'''MATCH (n1:{p1.node_name}), (n2:{p2.node_name})
-                            WHERE n1.id = {p1.id} AND n2.id = {p2.id}
-                            CREATE (n1)-{is_similar}->(n2), (n2)-{is_similar}->(n1)'''
-                _ = session.run(query)
-                count += 2
-
-    total = len(pairs)
-    pct = count / total * 100
+    query = f'''UNWIND $rows AS row
+                MATCH (n1:{cls1.node_name} {{id: row.id1}}), (n2:{cls2.node_name} {{id: row.id2}})
+                CREATE (n1)-[:Is_Similar {{score: row.score}}]->(n2),
+                       (n2)-[:Is_Similar {{score: row.score}}]->(n1)'''
+
+    write_batches(session, query, similar, progress=True)
+
+    count = 2 * len(similar)
+    pct = count / total * 100 if total else 0
     print(f'{count} new {relation} (total={total}, {pct:.2f}%)')
 
 
-def zillowZillowConnect(driver):
+# Makes sure ids are indexed before relationships are created, otherwise every
+# MATCH on id in create_similar is a label scan. Same constraints as
+# cyphers/0_init.cyphers, only created if the db was initialized without them.
+def createIdConstraints(session):
+    for name, cls in (('property_id', ZPFG), ('rental_id', APFG)):
+        query = f'CREATE CONSTRAINT {name} IF NOT EXISTS ON (n:{cls.node_name}) ASSERT n.id IS UNIQUE'
+        session.run(query).consume()
+
+
+# Stores each property's stripped street on its node and indexes it, so that
+# properties on the same street can be found by zillowSameStreetConnect.
+def storeStrippedStreets(session, zillow):
+    query = '''UNWIND $rows AS row
+               MATCH (p:Property {id: row.id})
+               SET p.stripped_street = row.street'''
+
+    rows = [{'id': i, 'street': strip_street(street)}
+            for i, street in zip(zillow['id'], zillow['street'])]
+
+    session.run('''CREATE INDEX property_stripped_street IF NOT EXISTS
+                   FOR (p:Property) ON (p.stripped_street)''').consume()
+
+    write_batches(session, query, rows)
+
+
+# Scores and links zillow properties on the same street inside neo4j instead
+# of sending them through python. Uses the same weights as
+# ZPFG.zillowCompare with the street match (0.2) always counted.
+def zillowSameStreetConnect(session, threshold):
+    score = ' + '.join((f'0.5 * {cypher_num_sim("price", 0.3)}',
+                        '0.2',
+                        f'0.1 * {cypher_num_sim("bed", 0.5)}',
+                        f'0.1 * {cypher_num_sim("bath", 0.5)}',
+                        f'0.1 * {cypher_num_sim("size", 0.3)}'))
+
+    outer = '''MATCH (p1:Property) WHERE p1.stripped_street IS NOT NULL
+               MATCH (p2:Property {stripped_street: p1.stripped_street})
+               WHERE id(p1) < id(p2)
+               RETURN p1, p2'''
+    inner = f'''WITH p1, p2, {score} AS score
+                WHERE score >= $threshold
+                CREATE (p1)-[:Is_Similar {{score: score}}]->(p2),
+                       (p2)-[:Is_Similar {{score: score}}]->(p1)'''
+
+    print(f'Creating {relation_name(ZPFG, ZPFG)} on the same street')
+
+    result = periodic_iterate(session, outer, inner, threshold=threshold)
+
+    print(f"{result['updateStatistics']['relationshipsCreated']} new "
+          f"{relation_name(ZPFG, ZPFG)} on the same street (total={result['total']})")
+
+
+def zillowZillowConnect(session):
     # Get data from db
     print('Fetching zillow data')
 
-    with driver.session() as session:
-        query = '''
-            MATCH (p:Property)-[:Located_In]->(c:City)
-            OPTIONAL MATCH (p)-[:Located_In]->(n:Neighborhood)
-            RETURN p.id, p.price, p.street, p.size, p.bed, p.bath,
-                    c.name AS city,
-                    collect(n.name) AS neighborhood
-        '''
-        results = session.run(query)
-        zillow_props = [ZPFG(r) for r in results]
-
-    # Do all comparisons and add relationships
+    query = '''
+        MATCH (p:Property)-[:Located_In]->(c:City)
+        OPTIONAL MATCH (p)-[:Located_In]->(n:Neighborhood)
+        RETURN p.id, p.price, p.street, p.size, p.bed, p.bath,
+                c.name AS city,
+                collect(n.name) AS neighborhood
+    '''
+    zillow = fetch_columns(session, query)
+
+    # Score pairs on the same street inside neo4j
     threshold = 0.7
-    connect_nodes(driver, combinations(zillow_props, 2), threshold)
+    storeStrippedStreets(session, zillow)
+    zillowSameStreetConnect(session, threshold)
+
+    # Do all other comparisons at once and add relationships
+    score = zillow_score_matrix(zillow, same_street=False)
+    idx1, idx2 = np.nonzero(np.triu(score >= threshold, k=1))
+    similar = similar_pairs(zillow, zillow, idx1, idx2, score[idx1, idx2], threshold)
 
-    return zillow_props
+    n = len(zillow['id'])
+    create_similar(session, similar, ZPFG, ZPFG, n * (n - 1) // 2)
 
+    return zillow
 
-def zillowAirbnbConnect(driver, zillow_props):
+
+def zillowAirbnbConnect(session, zillow):
     # Get data from db
     print('Fetching airbnb data')
 
-    with driver.session() as session:
-        query = '''
-            MATCH (r:Rental)-[:Located_In]->(c:City)
-            OPTIONAL MATCH (r)-[:Located_In]->(n:Neighborhood)
-            RETURN r.id, r.bed, r.bath, r.type_id, r.amenity_ids, r.amenity_names,
-                    c.name AS city,
-                    collect(n.name) AS neighborhood
-        '''
-        results = session.run(query)
-        airbnb_props = [APFG(r) for r in results]
-
-    # Do all airbnb comparisons and add relationships
+    query = '''
+        MATCH (r:Rental)-[:Located_In]->(c:City)
+        OPTIONAL MATCH (r)-[:Located_In]->(n:Neighborhood)
+        RETURN r.id, r.bed, r.bath, r.type_id, r.amenity_ids, r.amenity_names,
+                c.name AS city,
+                collect(n.name) AS neighborhood
+    '''
+    airbnb = fetch_columns(session, query)
+
+    # Do airbnb comparisons for pairs in the same neighborhood/city and add
+    # relationships
     threshold = 0.98
-    connect_nodes(driver, combinations(airbnb_props, 2), threshold)
+    idx1, idx2 = neighborhood_candidates(airbnb, airbnb)
+    idx1, idx2, score = parallel_scores(airbnb_scores, airbnb_arrays(airbnb),
+                                        idx1, idx2, threshold)
+    similar = similar_pairs(airbnb, airbnb, idx1, idx2, score, threshold)
+
+    n = len(airbnb['id'])
+    create_similar(session, similar, APFG, APFG, n * (n - 1) // 2)
 
-    # Do all zillow comparisons and add relationships
+    # Do zillow comparisons for pairs in the same neighborhood/city and add
+    # relationships
     threshold = 0.95
-    connect_nodes(driver, product(zillow_props, airbnb_props), threshold)
+    zillow_idx, airbnb_idx = neighborhood_candidates(zillow, airbnb)
+    zillow_idx, airbnb_idx, score = parallel_scores(
+        zillow_airbnb_scores, zillow_airbnb_arrays(zillow, airbnb),
+        zillow_idx, airbnb_idx, threshold)
+    similar = similar_pairs(zillow, airbnb, zillow_idx, airbnb_idx, score, threshold)
 
-    return airbnb_props
+    total = len(zillow['id']) * len(airbnb['id'])
+    create_similar(session, similar, ZPFG, APFG, total)
+
+    return airbnb
 
 
 if __name__ == '__main__':
     start = time.time()
     driver = GraphDatabase.driver(uri, auth=(user, pw))
 
-    # This could be removed if MERGE is used instead of CREATE, but I believe that
-    # would be slower.
+    # One session is shared by every phase so its connection is reused.
     with driver.session() as session:
-        query = 'MATCH ()-[r:Is_Similar]-() DELETE r;'
-        _ = session.run(query)
+        # This could be removed if MERGE is used instead of CREATE, but I believe that
+        # would be slower. Deleted in batches so one huge transaction doesn't
+        # run the server out of memory.
+        periodic_iterate(session, 'MATCH ()-[r:Is_Similar]->() RETURN r', 'DELETE r',
+                         batch_size=50000)
+
+        createIdConstraints(session)
+
+        zillow = zillowZillowConnect(session)
+        airbnb = zillowAirbnbConnect(session, zillow)
 
-    zillow_props = zillowZillowConnect(driver)
-    airbnb_props = zillowAirbnbConnect(driver, zillow_props)
+    driver.close()
 
     print(f'\nElapsed time: {datetime.timedelta(seconds=time.time()-start)}')